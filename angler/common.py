@@ -2,9 +2,13 @@
 
 import _abcoll
 import collections
+import contextlib
+import ctypes
+import fcntl
 import grp
 import inspect
 import hashlib
+import json
 import logging
 import os
 import platform
@@ -13,8 +17,13 @@ import re
 import shutil
 import socket
 import spwd
+import stat
+import tempfile
 from subprocess import Popen, PIPE
+import Queue
 import sys
+import threading
+import time
 import topsort
 
 logger = logging.getLogger()
@@ -24,6 +33,27 @@ class collection(dict): __getattr__,__setattr__,__delattr__ = dict.get,dict.__se
 def md5sum(content):
 	return hashlib.md5(content).hexdigest()
 
+def same_content(path, content, size=None, blocksize=65536):
+	#Compares the file at path with content a block at a time, stopping at
+	#the first difference. size is the file's size if already known.
+	if size is not None and size != len(content):
+		return False
+	with open(path, 'rb') as f:
+		for offset in xrange(0, len(content), blocksize):
+			if f.read(blocksize) != content[offset:offset+blocksize]:
+				return False
+		return not f.read(1)
+
+def same_files(a, b, blocksize=65536):
+	with open(a, 'rb') as fa:
+		with open(b, 'rb') as fb:
+			while True:
+				x, y = fa.read(blocksize), fb.read(blocksize)
+				if x != y:
+					return False
+				elif not x:
+					return True
+
 class ReturnCode(Exception):
 	def __init__(self, cmd, expected, code, (stdout, stderr)):
 		Exception.__init__(self, "Expected %i, got %i from command %r" % (expected, code, ' '.join(map(str,cmd))))
@@ -49,14 +79,67 @@ def GREP(pattern, source):
 
 SEQUENCE_TYPES = (list, tuple, set, frozenset)
 
+class PathTrie(object):
+	'''
+	Definitions by file system path, one level of nesting per component
+
+	>>> trie = PathTrie()
+	>>> trie.add('/srv/www', 'www')
+	>>> trie.add('/srv/www/static/js', 'js')
+	>>> trie.get('/srv/www'), trie.get('/srv/www/static'), trie.get('/srv/ftp')
+	('www', None, None)
+	'''
+	def __init__(self):
+		#Each node maps component names to child nodes, and None to the
+		#definition of its own path if there is one
+		self.root = {}
+
+	def node(self, path, create=False):
+		node = self.root
+		for name in path.split('/'):
+			if not name:
+				continue
+			elif create:
+				node = node.setdefault(name, {})
+			elif name in node:
+				node = node[name]
+			else:
+				return None
+		return node
+
+	def get(self, path):
+		node = self.node(path)
+		return None if node is None else node.get(None)
+
+	def add(self, path, definition):
+		self.node(path, True)[None] = definition
+
 class Manifest(collections.MutableMapping):
+	#Number of definitions holding each named resource that may run at once
+	#in parallel mode, resources not listed here are exclusive
+	default_limits = {'apt':1, 'passwd':1, 'service':1, 'network':8}
+	#Seconds each definition took to process the last time it ran, by repr
+	timings_path = '/var/cache/angler/timings.json'
+	#When files replaced by atomic_file are flushed to disk: 'file' syncs
+	#each one before it is renamed into place, 'level' syncs everything
+	#written by a level of the graph once it is done and 'run' once at the
+	#end of the run. Parallel runs have no levels and treat 'level' as 'run'.
+	durability = 'file'
+	durabilities = ('file', 'level', 'run')
+
 	def __init__(self):
 		self.defs = collections.defaultdict(dict)
-		self.sorter = topsort.Topsort()
+		self.sorter = topsort.Topsort(checked=True)
+		self.paths = PathTrie()
 		self.listeners = collections.defaultdict(set)
 		self.skipped = 0
 		self.errors = 0
 		self.history = set()
+		self.lock = threading.RLock()
+		self.limits = dict(self.default_limits)
+		self.timings = {}
+		self.facts = {}
+		self.unsynced = set()
 
 	def __getitem__(self, key):
 		return self.defs[key]
@@ -73,14 +156,35 @@ class Manifest(collections.MutableMapping):
 	def __iter__(self):
 		return iter(self.defs)
 
+	#The graph is changed under lock, as definitions created by runners in
+	#parallel mode add to it while the scheduler reads it
+
 	def add(self, obj, dep):
-		self.sorter.add(obj, dep)
-		#Check for cycles
-		for i in self.sorter:
-			pass
+		#Raises CycleError without keeping the edge if it would close a cycle
+		with self.lock:
+			self.sorter.add(obj, dep)
+
+	def link(self, obj, dep):
+		#Only for edges from a definition nothing depends on yet
+		with self.lock:
+			self.sorter.link(obj, dep)
 
 	def discard(self, obj, dep):
-		self.sorter.discard(obj, dep)
+		with self.lock:
+			self.sorter.discard(obj, dep)
+
+	def probe(self, key, name, load):
+		#Returns the result of load(), memoized until the next run or until
+		#key is invalidated
+		cache = self.facts.setdefault(key, {})
+		try:
+			return cache[name]
+		except KeyError:
+			value = cache[name] = load()
+			return value
+
+	def invalidate(self, key):
+		self.facts.pop(key, None)
 
 	def notify(self, obj, listener):
 		self.add(listener, obj)
@@ -111,43 +215,247 @@ class Manifest(collections.MutableMapping):
 	def runned(self):
 		return len(self.history)
 
-	def run(self, dryrun=False):
+	def run(self, dryrun=False, parallel=None):
+		if self.durability not in self.durabilities:
+			raise ValueError, "Unknown durability: %r" % self.durability
 		self.skipped = self.errors = 0
 		self.history = set()
+		self.facts = {}
 		logger = logging.getLogger(' ')
+		self.timings = self.load_timings()
 		try:
-			for node in list(self.sorter):
-				if node is None:
-					logger.info('Finished processing %i definitions (%i run, %i skipped, %i errors)', self.def_count, self.runned, self.skipped, self.errors)
-				elif not isinstance(node, fact):
-					try:
-						runners = node.runners(set(l for l in self.listeners[node] if l in self.history))
-					except AttributeError:
-						continue
-					try:
-						counts = False
-						for runner in runners or ():
-							if isinstance(runner, tuple):
-								runner, reason = runner
-							else:
-								reason = None
-							if not counts:
-								logger.info('Running %s %s', node, self.format_items(node.items()))
-								if reason:
-									logger.info('  (%s)', reason)
-							counts = True
-							self.history.add(node)
-							dryrun or runner()
-						if not counts:
-							self.skipped += 1
-							logger.debug('Skipping %s %s', node, self.format_items(node.items()))
-					except (KeyboardInterrupt,SystemError):
-						raise
-					except Exception, e:
-						logger.exception('Encountered error processing %s %s', node, self.format_items(node.items()))
-						self.errors += 1
+			if parallel:
+				self.run_parallel(parallel, dryrun, logger)
+			else:
+				for level in list(self.sorter.resolve()):
+					for node in level:
+						self.process(node, dryrun, logger)
+					if self.durability == 'level':
+						self.sync()
 		except KeyboardInterrupt:
 			sys.exit(1)
+		finally:
+			self.sync()
+		dryrun or self.save_timings()
+
+	def written(self, path):
+		#Called by atomic_file for each file it renamed into place without
+		#syncing it
+		with self.lock:
+			self.unsynced.add(path)
+
+	def sync(self):
+		#Flushes the files written since the last sync, then the folders
+		#holding them so the renames are durable too
+		with self.lock:
+			paths, self.unsynced = self.unsynced, set()
+		for path in paths:
+			fsync_path(path)
+		for folder in set(os.path.dirname(path) for path in paths):
+			fsync_path(folder)
+
+	def load_timings(self):
+		try:
+			with open(self.timings_path) as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			return {}
+
+	def save_timings(self):
+		try:
+			folder = os.path.dirname(self.timings_path)
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			with open(self.timings_path + '.new', 'w') as f:
+				json.dump(self.timings, f)
+			os.rename(self.timings_path + '.new', self.timings_path)
+		except (IOError, OSError), e:
+			logger.debug('Unable to save timings to %r: %s', self.timings_path, e)
+
+	def duration(self, node):
+		return self.timings.get(repr(node), 0.0) if isinstance(node, Definition) else 0.0
+
+	def priorities(self):
+		#Expected time from the start of each node until the last of its
+		#dependents finishes, using durations recorded by previous runs
+		remaining = {}
+		for level in reversed(list(self.sorter.resolve())):
+			for node in level:
+				after = [remaining[d] for d in self.sorter.after(node)]
+				remaining[node] = self.duration(node) + max(after or [0.0])
+		return remaining
+
+	def critical_path(self, remaining=None):
+		#The chain of definitions which bounds the length of a parallel run
+		remaining = self.priorities() if remaining is None else remaining
+		path, following = [], remaining.keys()
+		while following:
+			node = max(following, key=remaining.get)
+			if isinstance(node, Definition):
+				path.append(node)
+			with self.lock:
+				following = [n for n in self.sorter.after(node) if n in remaining]
+		return path
+
+	def run_parallel(self, workers, dryrun, logger):
+		#Dispatches each node to a pool of worker threads as soon as all of
+		#its dependencies have been processed. Like a serial run, it only
+		#processes the graph as it was when it started.
+		#Edges added while running are left out of both, so each count only
+		#drops for the dependencies it was taken from
+		with self.lock:
+			count = dict((node, len(deps)) for node,deps in self.sorter.vertices.items())
+			after = dict((node, set(self.sorter.after(node))) for node in count)
+		ready = [node for node,n in count.items() if not n]
+		remaining = self.priorities()
+		tasks, done, stop = Queue.Queue(), Queue.Queue(), object()
+		group = LogGroup()
+		def worker():
+			for node in iter(tasks.get, stop):
+				try:
+					with group:
+						self.process(node, dryrun, logger)
+				except BaseException:
+					done.put((node, sys.exc_info()))
+				else:
+					done.put((node, None))
+		threads = [threading.Thread(target=worker) for i in range(workers)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		group.install()
+		try:
+			running = finished = 0
+			held = collections.defaultdict(int)
+			while ready or running:
+				#Start whatever lies on the longest remaining chain first
+				ready.sort(key=remaining.get, reverse=True)
+				waiting = []
+				for node in ready:
+					if running < workers and self.claim(node, held):
+						tasks.put(node)
+						running += 1
+					else:
+						waiting.append(node)
+				ready = waiting
+				#A timeout keeps the wait interruptible by KeyboardInterrupt
+				while True:
+					try:
+						node, error = done.get(True, 1)
+						break
+					except Queue.Empty:
+						pass
+				self.release(node, held)
+				running -= 1
+				finished += 1
+				if error:
+					raise error[0], error[1], error[2]
+				for dependent in after[node]:
+					count[dependent] -= 1
+					if not count[dependent]:
+						ready.append(dependent)
+			if finished < len(count):
+				raise topsort.CycleError([node for node,n in count.items() if n])
+		finally:
+			group.uninstall()
+			for thread in threads:
+				tasks.put(stop)
+		for thread in threads:
+			thread.join()
+		path = self.critical_path(remaining)
+		logger.info('Critical path takes %.2fs: %s', sum(map(self.duration, path)), ' > '.join(map(repr, path)))
+
+	@staticmethod
+	def resources(node):
+		return node.resources if isinstance(node, Definition) else ()
+
+	def claim(self, node, held):
+		resources = self.resources(node)
+		if any(held[r] >= max(1, self.limits.get(r, 1)) for r in resources):
+			return False
+		for r in resources:
+			held[r] += 1
+		return True
+
+	def release(self, node, held):
+		for r in self.resources(node):
+			held[r] -= 1
+
+	def process(self, node, dryrun, logger):
+		if node is None:
+			logger.info('Finished processing %i definitions (%i run, %i skipped, %i errors)', self.def_count, self.runned, self.skipped, self.errors)
+		elif not isinstance(node, fact):
+			start = time.time()
+			try:
+				runners = node.runners(set(l for l in self.listeners[node] if l in self.history))
+			except AttributeError:
+				return
+			try:
+				counts = False
+				for runner in runners or ():
+					if isinstance(runner, tuple):
+						runner, reason = runner
+					else:
+						reason = None
+					if not counts:
+						logger.info('Running %s %s', node, self.format_items(node.items()))
+						if reason:
+							logger.info('  (%s)', reason)
+					counts = True
+					with self.lock:
+						self.history.add(node)
+					if not dryrun:
+						runner()
+						self.invalidate(node.args)
+				if not counts:
+					with self.lock:
+						self.skipped += 1
+					logger.debug('Skipping %s %s', node, self.format_items(node.items()))
+			except (KeyboardInterrupt,SystemError):
+				raise
+			except Exception, e:
+				logger.exception('Encountered error processing %s %s', node, self.format_items(node.items()))
+				with self.lock:
+					self.errors += 1
+			#A skipped node says nothing about how long its work takes
+			if counts and not dryrun:
+				self.timings[repr(node)] = time.time() - start
+
+class LogGroup(logging.Filter):
+	#Holds back the records logged by a thread while it is inside the group,
+	#then emits them together so output from parallel runners isn't interleaved
+	def __init__(self):
+		logging.Filter.__init__(self)
+		self.local = threading.local()
+		self.lock = threading.Lock()
+
+	def install(self):
+		for handler in logging.root.handlers:
+			handler.addFilter(self)
+
+	def uninstall(self):
+		for handler in logging.root.handlers:
+			handler.removeFilter(self)
+
+	def filter(self, record):
+		buffer = getattr(self.local, 'buffer', None)
+		if buffer is None:
+			return True
+		if not buffer or buffer[-1] is not record:
+			buffer.append(record)
+		return False
+
+	def __enter__(self):
+		self.local.buffer = []
+
+	def __exit__(self, obj, exc, tb):
+		records, self.local.buffer = self.local.buffer, None
+		with self.lock:
+			for record in records:
+				if record.name == 'root':
+					logging.root.handle(record)
+				else:
+					logging.getLogger(record.name).handle(record)
 
 manifest = Manifest()
 
@@ -230,6 +538,7 @@ class param(ProxyVal):
 		if self.name in inst.manifest[inst.args] and inst.manifest[inst.args][self.name] != value:
 			raise ValueError, "parameter %r of %r already set to %r" % (self.name, inst, value)
 		inst.manifest[inst.args][self.name] = result
+		inst.manifest.invalidate(inst.args)
 		return result
 
 	@classmethod
@@ -282,9 +591,9 @@ class ManifestMetaClass(_abcoll.ABCMeta):
 			def __init__(self, *args, **kwargs):
 				if len(args) > len(arg_names):
 					raise TypeError, "Expected %i arguments, got %i" % (len(arg_names), len(args))
+				super(self.__class__, self).__init__(*args)
 				for key in kwargs:
 					def_props[key].__set__(self, kwargs[key])
-				super(self.__class__, self).__init__(*args)
 			attr['__init__'] = __init__
 		for i,arg in enumerate(arg_names):
 			attr.setdefault(arg, property(lambda self:self.args[i+1]))
@@ -299,6 +608,8 @@ class ManifestMetaClass(_abcoll.ABCMeta):
 class Definition(Proxy):
 	__metaclass__ = ManifestMetaClass
 	manifest = manifest
+	#Names of resources held while processing, see Manifest.limits
+	resources = ()
 	def __init__(self, *args, **kwargs):
 		self.args = (self.__class__.__name__,) + args
 		Proxy.__init__(self, self.manifest[self.args])
@@ -359,7 +670,7 @@ class fact(object):
 		try:
 			value = proxy[self.param.name]
 		except KeyError:
-			value = self.param.default(self.inst)
+			value = self.inst.manifest.probe(self.inst.args, self.param.name, lambda:self.param.default(self.inst))
 		return value() if isinstance(value, fact) else value
 
 	def __getattr__(self, name):
@@ -389,42 +700,360 @@ class mode(int):
 
 import base64
 import hashlib
+
+class CacheStore(object):
+	#Content addressed store for downloads. Each object is kept under its
+	#sha256 digest and index.json maps uris to objects and records when each
+	#object was last used, so the least recently used are evicted first once
+	#the store exceeds quota bytes. The index is only read and written under
+	#an exclusive flock, so parallel runners and processes can share it.
+	#ETag and Last-Modified headers are kept to revalidate objects with
+	#conditional requests, made through opener (a urllib2.OpenerDirector).
+	def __init__(self, basedir, quota=None, opener=None):
+		self.basedir = basedir
+		self.quota = quota
+		self.opener = opener or urllib2.build_opener()
+
+	def object_path(self, digest):
+		return os.path.join(self.basedir, 'objects', digest[:2], digest)
+
+	@contextlib.contextmanager
+	def index(self, write=True):
+		if not os.path.isdir(self.basedir):
+			os.makedirs(self.basedir)
+		with open(os.path.join(self.basedir, 'index.lock'), 'a') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			try:
+				with open(os.path.join(self.basedir, 'index.json')) as f:
+					index = json.load(f)
+			except (IOError, ValueError):
+				index = {'uris':{}, 'objects':{}}
+			yield index
+			if write:
+				with atomic_file(os.path.join(self.basedir, 'index.json')) as f:
+					json.dump(index, f)
+
+	def entry(self, uri):
+		#Index entry for uri if its object is still in the store
+		with self.index(write=False) as index:
+			entry = index['uris'].get(uri)
+		if entry is not None and os.path.exists(self.object_path(entry['digest'])):
+			return entry
+
+	def request(self, uri, entry=None):
+		#Opens uri, conditionally on it having changed since entry was stored
+		request = urllib2.Request(str(uri))
+		if entry and entry.get('etag'):
+			request.add_header('If-None-Match', entry['etag'])
+		if entry and entry.get('modified'):
+			request.add_header('If-Modified-Since', entry['modified'])
+		try:
+			return self.opener.open(request)
+		except urllib2.HTTPError, e:
+			if entry and e.code == 304:
+				return None
+			raise
+
+	def changed(self, uri):
+		#Revalidates the object cached for uri, returns None if it is still
+		#current upstream or else the open response with the new content to
+		#pass on to fetch. Objects stored without validators are assumed to
+		#be current.
+		entry = self.entry(uri)
+		if entry is None:
+			return self.request(uri)
+		if entry.get('etag') or entry.get('modified'):
+			response = self.request(uri, entry)
+			if response is not None:
+				return response
+		self.lookup(uri)
+		return None
+
+	def lookup(self, uri):
+		#Path of the object cached for uri or None, marks it as used
+		with self.index() as index:
+			entry = index['uris'].get(uri)
+			if entry is None or not os.path.exists(self.object_path(entry['digest'])):
+				return None
+			index['objects'][entry['digest']]['atime'] = time.time()
+			return self.object_path(entry['digest'])
+
+	def fetch(self, uri, response=None):
+		#Downloads uri, or reads response if it was already opened, into the
+		#store unless the cached object is still current, and returns the
+		#path of its object
+		fsrc = response or self.request(uri, self.entry(uri))
+		if fsrc is None:
+			return self.lookup(uri)
+		tempdir = os.path.join(self.basedir, 'tmp')
+		if not os.path.isdir(tempdir):
+			os.makedirs(tempdir)
+		fd, temp = tempfile.mkstemp(dir=tempdir)
+		try:
+			h = hashlib.sha256()
+			headers = fsrc.info()
+			try:
+				with os.fdopen(fd, 'wb') as fdest:
+					size = stream(fsrc, fdest, h)
+					fdest.flush()
+					os.fsync(fdest.fileno())
+			finally:
+				fsrc.close()
+			return self.add(uri, temp, h.hexdigest(), size,
+			 headers.getheader('ETag'), headers.getheader('Last-Modified'))
+		finally:
+			if os.path.exists(temp):
+				os.unlink(temp)
+
+	def add(self, uri, temp, digest, size, etag=None, modified=None):
+		path = self.object_path(digest)
+		with self.index() as index:
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			os.rename(temp, path)
+			old = index['uris'].get(uri)
+			index['uris'][uri] = {'digest':digest, 'etag':etag, 'modified':modified}
+			index['objects'][digest] = {'size':size, 'atime':time.time()}
+			#The previous version of uri is dropped unless another uri has
+			#the same content
+			if old is not None and old['digest'] != digest and \
+			 not any(e['digest'] == old['digest'] for e in index['uris'].values()):
+				self.drop(index, old['digest'])
+			self.evict(index, digest)
+		return path
+
+	def drop(self, index, digest):
+		getLogger('cache').debug('dropping %s', digest)
+		try:
+			os.unlink(self.object_path(digest))
+		except OSError:
+			pass
+		return index['objects'].pop(digest, {'size':0})['size']
+
+	def evict(self, index, keep):
+		if self.quota is None:
+			return
+		objects = index['objects']
+		total = sum(o['size'] for o in objects.values())
+		for digest in sorted(objects, key=lambda d:objects[d]['atime']):
+			if total <= self.quota:
+				break
+			if digest != keep:
+				total -= self.drop(index, digest)
+		for uri, entry in index['uris'].items():
+			if entry['digest'] not in objects:
+				del index['uris'][uri]
+
 class Cache(Definition):
-	#TODO: Cache is a remote file which is fetched whenever it's needed and kept
-	#around as long as cached files don't exceed a configurable size quota.
-	quota = None
+	#A remote file which is fetched whenever it's needed and kept around as
+	#long as cached files don't exceed a configurable size quota, in bytes.
+	#Set quota to None to keep everything still in use.
+	quota = 1 << 30
 	basedir = '/var/cache/angler'
+	opener = None
+	resources = ('network',)
 
 	def __init__(self, uri):
 		Definition.__init__(self, uri)
 		self.requires(Folder(self.basedir))
 
+	@classmethod
+	def store(cls):
+		return CacheStore(cls.basedir, cls.quota, cls.opener)
+
 	@param.read_only
 	def path(self):
-		return os.path.join(self.basedir, hashlib.md5(self.uri)) 
+		return self.store().lookup(self.uri)
 
-	def fetch_uri(self):
-		if not os.path.exists(self.path):
-			w = open(self.path, 'wb')
-			u = urllib2.urlopen(self.uri)
-			b = u.read(4096)
-			while b:
-				w.write(b)
-				b = u.read(4096)
+	def fetch_uri(self, response=None):
+		self.store().fetch(self.uri, response)
 
 	def runners(self, notifiers):
-		yield self.fetch_uri
+		#Runs, and so notifies the paths using it, only when the content
+		#has changed upstream. The response of the revalidation is what gets
+		#stored, so changed content is only transferred once.
+		if self.path() is None:
+			yield self.fetch_uri, "Not cached"
+		else:
+			response = self.store().changed(self.uri)
+			if response is not None:
+				try:
+					yield (lambda:self.fetch_uri(response)), "Changed upstream"
+				finally:
+					response.close()
 
 from urlparse import urlparse as uriparse
 
-def stream(fsrc, fdest):
-	fdest.write(fsrc.read())
-	#buff = fsrc.read(4096)
-	#while buff:
-		#fdest.write(buff)
-		#buff = fsrc.read(4096)
-	#fsrc.close()
-	#fdest.close()
+def stream(fsrc, fdest, digest=None, blocksize=65536):
+	#Copies fsrc to fdest a block at a time, feeding each block to digest if
+	#given, and returns the number of bytes copied
+	length = 0
+	buff = fsrc.read(blocksize)
+	while buff:
+		fdest.write(buff)
+		if digest is not None:
+			digest.update(buff)
+		length += len(buff)
+		buff = fsrc.read(blocksize)
+	return length
+
+def fsync_path(path):
+	#Flushes a file or folder to disk, if it still exists
+	try:
+		fd = os.open(path, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def temp_path(path):
+	#Hidden name next to path to write a replacement for it under
+	dirname, basename = os.path.split(path)
+	return os.path.join(dirname, '.%s.%s' % (basename, os.urandom(4).encode('hex')))
+
+class atomic_file(object):
+	#Context manager for a temporary file next to path, which replaces path
+	#only once it has been completely written. Depending on
+	#Manifest.durability it is flushed to disk before the rename or later
+	#along with every other file written in the same level or run. The
+	#permissions and owner of an existing file are kept, new files are
+	#created with mode as modified by the umask. A symlink at path is
+	#followed, so the file it points to is replaced rather than the link.
+	def __init__(self, path, mode=0666):
+		self.path = path
+		self.mode = mode
+
+	def __enter__(self):
+		self.target = os.path.realpath(self.path)
+		self.temp = temp_path(self.target)
+		self.file = os.fdopen(os.open(self.temp, os.O_WRONLY|os.O_CREAT|os.O_EXCL, self.mode), 'wb')
+		return self.file
+
+	def __exit__(self, obj, exc, tb):
+		try:
+			durable = manifest.durability == 'file'
+			if obj is None:
+				self.file.flush()
+				if durable:
+					os.fsync(self.file.fileno())
+			self.file.close()
+			if obj is None:
+				try:
+					s = os.stat(self.target)
+				except OSError:
+					pass
+				else:
+					os.chmod(self.temp, stat.S_IMODE(s.st_mode))
+					os.chown(self.temp, s.st_uid, s.st_gid)
+				os.rename(self.temp, self.target)
+				if durable:
+					fsync_path(os.path.dirname(self.target))
+				else:
+					manifest.written(self.target)
+		finally:
+			if os.path.exists(self.temp):
+				os.unlink(self.temp)
+
+libc = ctypes.CDLL(None, use_errno=True)
+FICLONE = 0x40049409
+
+def _kernel_call(name):
+	#Wraps a libc call which returns a byte count or -1 with errno set
+	func = getattr(libc, name, None)
+	if func is None:
+		return None
+	func.restype = ctypes.c_ssize_t
+	def call(*args):
+		result = func(*args)
+		if result < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno))
+		return result
+	return call
+
+_copy_file_range = _kernel_call('copy_file_range')
+_sendfile = _kernel_call('sendfile')
+
+def kernel_copy(infd, outfd, size, chunk=1<<30):
+	#Copies size bytes between file descriptors without passing them
+	#through userspace. Returns the method used, or None if the kernel or
+	#filesystem supports none of them and nothing was copied.
+	try:
+		fcntl.ioctl(outfd, FICLONE, infd)
+		return 'reflink'
+	except IOError:
+		pass
+	methods = (
+		('copy_file_range', _copy_file_range and (lambda n:_copy_file_range(infd, None, outfd, None, ctypes.c_size_t(n), 0))),
+		('sendfile', _sendfile and (lambda n:_sendfile(outfd, infd, None, ctypes.c_size_t(n)))),
+	)
+	for name, call in methods:
+		if call is None:
+			continue
+		copied = 0
+		try:
+			while copied < size:
+				n = call(min(chunk, size - copied))
+				if not n:
+					break
+				copied += n
+			return name
+		except OSError:
+			if copied:
+				raise
+
+def copy_file(src, path, link=False):
+	#Copies src over path atomically, keeping its mtime. Hardlinks when link
+	#is true and both are on the same filesystem, otherwise lets the kernel
+	#copy the data when it can. Returns the method used.
+	s = os.stat(src)
+	if link:
+		if os.path.exists(path) and os.path.samefile(src, path):
+			return 'link'
+		temp = temp_path(path)
+		try:
+			os.link(src, temp)
+			os.rename(temp, path)
+			return 'link'
+		except OSError:
+			pass
+		finally:
+			#rename does nothing if both are links to the same file
+			if os.path.lexists(temp):
+				os.unlink(temp)
+	with open(src, 'rb') as fsrc:
+		with atomic_file(path, stat.S_IMODE(s.st_mode)) as fdest:
+			method = kernel_copy(fsrc.fileno(), fdest.fileno(), s.st_size)
+			if method is None:
+				stream(fsrc, fdest)
+				method = 'stream'
+	os.utime(path, (s.st_atime, s.st_mtime))
+	return method
+
+def parse_checksum(value):
+	#Splits 'algorithm:hexdigest', for any algorithm hashlib knows
+	algorithm, _, expected = value.partition(':')
+	try:
+		hashlib.new(algorithm)
+	except ValueError:
+		raise ValueError, "Invalid checksum: %r" % value
+	return algorithm, expected.lower()
+
+def install(fsrc, path, digest=None, size=None, source=None):
+	#Streams fsrc into path through a temporary file, so a failed or
+	#corrupt copy never replaces path. digest is 'algorithm:hexdigest'.
+	algorithm, expected = parse_checksum(digest) if digest else ('md5', None)
+	h = hashlib.new(algorithm)
+	source = source or getattr(fsrc, 'name', fsrc)
+	with atomic_file(path) as fdest:
+		length = stream(fsrc, fdest, h)
+		if size is not None and length != size:
+			raise IOError, "Expected %i bytes from %s, got %i" % (size, source, length)
+		if expected and h.hexdigest() != expected:
+			raise IOError, "Expected %s digest %s from %s, got %s" % (algorithm, expected, source, h.hexdigest())
+	return length
 
 class uri(str):
 	"""
@@ -455,42 +1084,70 @@ import urllib2
 
 class Path(Definition):
 	def __init__(self, path):
+		#Paths are interned in the manifest, so each folder is linked to its
+		#parent once however many paths lie below it. They are normalized
+		#first, as the trie doesn't tell '/srv/www/' from '/srv/www'.
+		path = os.path.normpath(path)
+		known = self.manifest.paths.get(path) is not None
 		Definition.__init__(self, path)
-		try:
-			self.requires(self.parent)
-		except OSError:
-			pass
+		if not known:
+			self.manifest.paths.add(path, self)
+			try:
+				#Nothing can depend on a new path yet
+				self.manifest.link(self, self.parent)
+			except OSError:
+				pass
 
 	def child(self, path, **kwargs):
 		kwargs.setdefault('state', 'folder')
 		return Path(os.path.join(self.path, path), **kwargs)
 
+	@classmethod
+	def folder(cls, path):
+		#The interned definition of path, which is required to be a folder
+		path = os.path.normpath(path)
+		known = cls.manifest.paths.get(path)
+		if known is None:
+			return Path(path, state='folder')
+		if known.get('state') != 'folder':
+			known.state = 'folder'
+		return known
+
 	@property
 	def parent(self):
 		p, _ = os.path.split(self.path)
 		if len(p) > 1:
-			return Path(p, state='folder')
+			return self.folder(p)
 		else:
 			raise OSError, "Root has no parent"
 
+	@param.read_only
+	def lstat(self):
+		#The other probes derive from this single lstat, which is memoized
+		#like any fact and so taken again only after a runner has executed
+		try:
+			return os.lstat(self.path)
+		except OSError:
+			return None
+
 	@param.enum('folder', 'file', 'absent', 'link')
 	def state(self, new):
 		return new.lower()
 	@state.fetch
 	def state(self):
-		if os.path.exists(self.path):
-			if os.path.isdir(self.path):
-				return 'folder'
-			elif os.path.islink(self.path):
-				return 'link'
-			elif os.path.isfile(self.path):
-				return 'file'
-		else:
+		s = self.lstat()
+		if s is None:
 			return 'absent'
+		elif stat.S_ISDIR(s.st_mode):
+			return 'folder'
+		elif stat.S_ISLNK(s.st_mode):
+			return 'link'
+		elif stat.S_ISREG(s.st_mode):
+			return 'file'
 
 	@param
 	def owner(self):
-		return User.fromuid(os.stat(self.path).st_uid)
+		return User.fromuid(self.lstat().st_uid)
 	@owner.validator
 	def owner(self, new):
 		if isinstance(new, (User, fact)):
@@ -503,7 +1160,7 @@ class Path(Definition):
 
 	@param
 	def group(self):
-		return Group.fromgid(os.stat(self.path).st_gid)
+		return Group.fromgid(self.lstat().st_gid)
 	@group.validator
 	def group(self, new):
 		if isinstance(new, (Group, fact)):
@@ -516,10 +1173,8 @@ class Path(Definition):
 
 	@param
 	def mode(self):
-		if os.path.exists(self.path):
-			return mode(os.stat(self.path).st_mode)
-		else:
-			return mode(0644)
+		s = self.lstat()
+		return mode(0644) if s is None else mode(s.st_mode)
 	@mode.validator
 	def mode(self, new):
 		if isinstance(new, int):
@@ -528,8 +1183,9 @@ class Path(Definition):
 
 	@param
 	def content(self):
-		if os.path.exists(self.path):
-			return open(self.path, 'rb').read()
+		if self.lstat() is not None:
+			with open(self.path, 'rb') as f:
+				return f.read()
 		else:
 			return None
 	@content.validator
@@ -540,7 +1196,48 @@ class Path(Definition):
 
 	@param.no_default
 	def source(self, new):
-		return uri(new)
+		#Remote sources are fetched through the download cache
+		new = uri(new)
+		if new.scheme in ('http','https'):
+			Cache(new).notifies(self)
+		return new
+
+	@param.no_default
+	def checksum(self, new):
+		parse_checksum(new)
+		return new
+
+	@param.no_default
+	def size(self, new):
+		if isinstance(new, (int, long)) and new >= 0:
+			return new
+		raise ValueError, "Invalid size: %r" % new
+
+	#Whether file:// sources may be hardlinked. The file then shares its
+	#owner and mode with the source.
+	hardlink = param.boolean('hardlink', False)
+
+	#Whether file:// sources with the same size and mtime as the file are
+	#also compared by content before skipping the copy
+	verify = param.boolean('verify', False)
+
+	def source_matches(self):
+		#Compares the file a symlink points to, which is what gets copied to
+		src = self.source().path
+		try:
+			s = os.stat(self.path)
+		except OSError:
+			return False
+		t = os.stat(src)
+		if (t.st_size, int(t.st_mtime)) != (s.st_size, int(s.st_mtime)):
+			return False
+		return not self.verify() or same_files(src, self.path)
+
+	def regular_size(self):
+		#Size of the file for a quick comparison, None unless it's a regular
+		#file as lstat gives the length of the target for a link
+		s = self.lstat()
+		return s.st_size if stat.S_ISREG(s.st_mode) else None
 
 	def create_folder(self):
 		getLogger('path').debug('os.mkdir(%r)', self.path)
@@ -550,26 +1247,33 @@ class Path(Definition):
 		source = self.source()
 		log = getLogger('path')
 		if source:
-			if source.scheme == 'file':
+			if source.scheme == 'file' and (self.checksum() or self.size() is not None):
 				log.debug('copying %r to %r', source.path, self.path)
-				shutil.copy(source.path, self.path)
+				with open(source.path, 'rb') as fsrc:
+					install(fsrc, self.path, self.checksum(), self.size())
+				shutil.copystat(source.path, self.path)
+			elif source.scheme == 'file':
+				method = copy_file(source.path, self.path, self.hardlink())
+				log.debug('copied %r to %r (%s)', source.path, self.path, method)
 			elif source.scheme in ('http','https'):
-				log.debug('downloading %r to %r', source, self.path)
-				#log.debug('got %r', urllib2.urlopen(source).read())
-				#with open(self.path, 'wb') as dest:
-					#dest.write(urllib2.urlopen(source).read())
-				stream(urllib2.urlopen(str(source)), open(self.path, 'wb'))
+				cached = Cache(source).path()
+				if cached is None:
+					raise IOError, "%s is not in the download cache" % source
+				log.debug('copying %r from %r to %r', source, cached, self.path)
+				with open(cached, 'rb') as fsrc:
+					install(fsrc, self.path, self.checksum(), self.size(), source)
 		else:
 			content = self.content()
 			log.debug("writing ~%s to %r", md5sum(content), self.path)
-			open(self.path, 'wb').write(content)
+			with atomic_file(self.path) as f:
+				f.write(content)
 
 	def create_link(self):
 		getLogger('path').debug("os.symlink(%r, %r)", self.path, self.content())
 		os.symlink(self.content(), self.path)
 
 	def remove(self):
-		if os.path.isdir(self.path):
+		if stat.S_ISDIR(self.lstat().st_mode):
 			getLogger('path').debug('shutil.rmtree(%r)', self.path)
 			shutil.rmtree(self.path)
 		else:
@@ -577,7 +1281,7 @@ class Path(Definition):
 			os.unlink(self.path)
 
 	def chown(self):
-		s = os.stat(self.path)
+		s = self.lstat()
 		uid, gid = -1, -1
 		if s.st_uid != self.owner().uid():
 			uid = self.owner().uid()
@@ -595,7 +1299,7 @@ class Path(Definition):
 
 	def runners(self, notifiers):
 		state = self.state()
-		exists = os.path.exists(self.path)
+		exists = self.lstat() is not None
 		if state == 'absent':
 			if exists:
 				yield self.remove
@@ -606,21 +1310,38 @@ class Path(Definition):
 				if not exists:
 					yield self.create_folder, "Folder doesn't exist"
 			elif state == 'file':
+				#Without explicit content the default is the file itself,
+				#so there is nothing to compare
+				managed = 'content' in self and self.content() is not None
 				if self.source() and not exists:
 					yield self.create_file, "File doesn't exist"
-				elif self.content() is None:
-					open(self.path,'wb')
+				elif self.source() and notifiers:
+					yield self.create_file, "Source changed"
+				elif self.source() and self.source().scheme == 'file' and not self.source_matches():
+					yield self.create_file, "Source changed"
+				elif self.source() and self.size() is not None and os.stat(self.path).st_size != self.size():
+					yield self.create_file, "File size doesn't match"
+				elif not managed:
+					if not exists:
+						open(self.path,'wb').close()
+						self.manifest.invalidate(self.args)
 				elif not exists:
 					yield self.create_file, "File doesn't exist"
-				elif open(self.path,'rb').read() != self.content():
+				elif not same_content(self.path, self.content(), self.regular_size()):
 					yield self.create_file, "File contents don't match"
 			elif state == 'link':
 				if not exists:
 					yield self.create_link, "Link doesn't exist"
-			s = os.stat(self.path)
+			s = self.lstat()
+			if s is None:
+				#Nothing was created during a dry run
+				yield self.chown
+				yield self.chmod
+				return
 			if s.st_uid != self.owner().uid() or s.st_gid != self.group.gid():
 				yield self.chown
-			if m != mode(s.st_mode):
+			#Symlink permissions are meaningless on Linux
+			if state != 'link' and m != mode(s.st_mode):
 				yield self.chmod
 
 	Folder = partialclass(state='folder')
@@ -631,11 +1352,222 @@ File   = Path.File
 Folder = Path.Folder
 Link   = Path.Link
 
+def scan(top):
+	#Maps the path of everything below top, relative to top, to its lstat.
+	#Folders come before their contents.
+	found, pending = {}, ['']
+	while pending:
+		rel = pending.pop()
+		for name in os.listdir(os.path.join(top, rel)):
+			sub = os.path.join(rel, name)
+			s = found[sub] = os.lstat(os.path.join(top, sub))
+			if stat.S_ISDIR(s.st_mode):
+				pending.append(sub)
+	return found
+
+class Tree(Definition):
+	'''
+	Keeps the folder at path a copy of a local source folder, as one
+	definition however many files it holds. Files are compared by type, size
+	and mtime, or also by content with verify, and only the differences are
+	copied. Files which only exist under path are kept unless purge is set.
+	'''
+	def __init__(self, path):
+		Definition.__init__(self, path)
+		parent = os.path.dirname(path)
+		if len(parent) > 1:
+			self.requires(Path.folder(parent))
+
+	@param.no_default
+	def source(self, new):
+		new = uri(new if '://' in new else 'file://' + new)
+		if new.scheme != 'file':
+			raise ValueError, "Tree source must be a local folder: %r" % new
+		return new
+
+	purge = param.boolean('purge', False)
+	verify = param.boolean('verify', False)
+	hardlink = param.boolean('hardlink', False)
+
+	@param.read_only
+	def changes(self):
+		#Relative paths to remove and to copy from the source, in the order
+		#they have to be processed in
+		src = self.source().path
+		wanted = scan(src)
+		try:
+			present = scan(self.path)
+		except OSError:
+			present = None
+		if present is None:
+			return [], sorted(wanted)
+		remove = set()
+		for rel, s in present.iteritems():
+			t = wanted.get(rel)
+			if t is None and self.purge() or \
+			 t is not None and stat.S_IFMT(s.st_mode) != stat.S_IFMT(t.st_mode):
+				remove.add(rel)
+		def removed(rel):
+			while rel:
+				if rel in remove:
+					return True
+				rel = os.path.dirname(rel)
+			return False
+		copy = []
+		for rel, t in wanted.iteritems():
+			s = present.get(rel)
+			if s is None or removed(rel):
+				copy.append(rel)
+			elif stat.S_ISLNK(t.st_mode):
+				if os.readlink(os.path.join(src, rel)) != os.readlink(os.path.join(self.path, rel)):
+					copy.append(rel)
+			elif stat.S_ISREG(t.st_mode):
+				if (s.st_size, int(s.st_mtime)) != (t.st_size, int(t.st_mtime)) or \
+				 self.verify() and not same_files(os.path.join(src, rel), os.path.join(self.path, rel)):
+					copy.append(rel)
+		#Removing a folder removes everything below it, and nested paths
+		#sort after their folder
+		remove = sorted(rel for rel in remove if not removed(os.path.dirname(rel)))
+		return remove, sorted(copy)
+
+	def sync(self):
+		log = getLogger('tree')
+		src = self.source().path
+		remove, copy = self.changes()
+		if not os.path.isdir(self.path):
+			log.debug('os.mkdir(%r)', self.path)
+			os.mkdir(self.path)
+		for rel in remove:
+			path = os.path.join(self.path, rel)
+			if os.path.isdir(path) and not os.path.islink(path):
+				log.debug('shutil.rmtree(%r)', path)
+				shutil.rmtree(path)
+			else:
+				log.debug('os.unlink(%r)', path)
+				os.unlink(path)
+		folders = []
+		for rel in copy:
+			source, path = os.path.join(src, rel), os.path.join(self.path, rel)
+			s = os.lstat(source)
+			if stat.S_ISDIR(s.st_mode):
+				if not os.path.isdir(path):
+					os.mkdir(path, stat.S_IMODE(s.st_mode))
+				folders.append((path, s))
+			elif stat.S_ISLNK(s.st_mode):
+				if os.path.lexists(path):
+					os.unlink(path)
+				os.symlink(os.readlink(source), path)
+			elif stat.S_ISREG(s.st_mode):
+				copy_file(source, path, self.hardlink())
+		#Copying into a folder changes its mtime, so folders are done last
+		for path, s in reversed(folders):
+			os.utime(path, (s.st_atime, s.st_mtime))
+		log.debug('synced %r to %r: %i removed, %i copied', src, self.path, len(remove), len(copy))
+
+	def runners(self, notifiers):
+		remove, copy = self.changes()
+		if remove or copy:
+			yield self.sync, "%i to copy, %i to remove" % (len(copy), len(remove))
+
+class Accounts(object):
+	#Indexes the passwd and group databases so lookups don't go through NSS
+	#each time. A snapshot is taken once per run by accounts() and taken
+	#again once a runner invalidates it after changing users or groups.
+	#Directories such as LDAP usually can't be enumerated, so with nss set
+	#entries missing from the snapshot are looked up one at a time and
+	#added to it. Group members are only known for enumerated groups.
+	def __init__(self, passwd, groups, nss=False):
+		self.nss = nss
+		self.missing = set()
+		self.users, self.uids = {}, {}
+		for p in passwd:
+			self.add_user(p)
+		self.groups, self.gids = {}, {}
+		self.members = collections.defaultdict(set)
+		for g in groups:
+			self.add_group(g)
+
+	def add_user(self, p):
+		self.users.setdefault(p.pw_name, p)
+		self.uids.setdefault(p.pw_uid, p)
+
+	def add_group(self, g):
+		self.groups.setdefault(g.gr_name, g)
+		self.gids.setdefault(g.gr_gid, g)
+		for m in g.gr_mem:
+			self.members[m].add(g.gr_name)
+
+	def lookup(self, index, key, fetch, add):
+		#Raises KeyError like the index itself if nothing is found
+		if key in index or not self.nss or (fetch, key) in self.missing:
+			return index[key]
+		try:
+			entry = fetch(key)
+		except KeyError:
+			self.missing.add((fetch, key))
+			raise
+		add(entry)
+		return entry
+
+	def user(self, name):
+		return self.lookup(self.users, name, pwd.getpwnam, self.add_user)
+
+	def uid(self, uid):
+		return self.lookup(self.uids, uid, pwd.getpwuid, self.add_user)
+
+	def group(self, name):
+		return self.lookup(self.groups, name, grp.getgrnam, self.add_group)
+
+	def gid(self, gid):
+		return self.lookup(self.gids, gid, grp.getgrgid, self.add_group)
+
+class AccountCommands(object):
+	#The default account backend, every change is made by running one of the
+	#shadow utilities. See angler.etc.passwd for an alternative.
+	flags = {'homedir':'-d', 'uid':'-u', 'group':'-g', 'comment':'--comment',
+	 'shell':'--shell', 'groups':'-G'}
+
+	def load(self):
+		return Accounts(pwd.getpwall(), grp.getgrall(), nss=True)
+
+	def attach(self, definition):
+		pass
+
+	def options(self, changes):
+		options = []
+		for key, value in changes:
+			options.extend([self.flags[key], ','.join(value) if key == 'groups' else value])
+		return options
+
+	def add_user(self, name, changes):
+		RUN('useradd', '-N', '-M', *(self.options(changes) + [name]))
+
+	def modify_user(self, name, changes):
+		RUN('usermod', *(self.options(changes) + [name]))
+
+	def delete_user(self, name):
+		RUN('userdel', name)
+
+	def add_group(self, name, gid=None):
+		RUN(*(['groupadd'] + (['-g', gid] if gid else []) + [name]))
+
+	def delete_group(self, name):
+		RUN('groupdel', name)
+
+Accounts.backend = AccountCommands()
+
+def accounts():
+	return manifest.probe('accounts', None, Accounts.backend.load)
+
+def invalidate_accounts():
+	manifest.invalidate('accounts')
+
 def getpwd(name):
 	try:
-		return pwd.getpwnam(name)
+		return accounts().user(name)
 	except KeyError:
 		p = type('struct_pwd', (object,), {})()
+		p.pw_passwd = None
 		p.pw_uid = None
 		p.pw_gid = None
 		p.pw_name = name
@@ -645,9 +1577,12 @@ def getpwd(name):
 		return p
 
 class User(Definition):
+	resources = ('passwd',)
+
 	def __init__(self, name):
 		Definition.__init__(self, name)
 		self < Group(name)
+		Accounts.backend.attach(self)
 
 	present = param.boolean('present', True)
 
@@ -694,7 +1629,7 @@ class User(Definition):
 	@param
 	def homedir(self):
 		try:
-			return Folder(pwd.getpwnam(self.name).pw_dir)
+			return Folder(accounts().user(self.name).pw_dir)
 		except KeyError:
 			return Folder('/home/%s' % self.name, owner=self)
 	@homedir.validator
@@ -716,10 +1651,7 @@ class User(Definition):
 
 	@param
 	def groups(self):
-		try:
-			return set(Group(g.gr_name) for g in grp.getgrall() if self.name in g.gr_mem)
-		except KeyError:
-			return set()
+		return set(Group(g) for g in accounts().members.get(self.name, ()))
 	@groups.validator
 	def groups(self, new):
 		if isinstance(new, (list,tuple,set)):
@@ -728,57 +1660,57 @@ class User(Definition):
 
 	@classmethod
 	def fromuid(cls, uid):
-		return cls(pwd.getpwuid(uid).pw_name)
-
-	def create(self):
-		RUN('useradd', '-N', '-M', self.name)
-
-	def set_homedir(self):
-		RUN('usermod', '-d', self.homedir().path, self.name)
-
-	def set_uid(self):
-		RUN('usermod', '-u', self.uid(), self.name)
-
-	def set_group(self):
-		RUN('usermod', '-g', self.group().gid(), self.name)
-
-	def set_comment(self):
-		RUN('usermod', '--comment', self.comment(), self.name)
-
-	def set_shell(self):
-		RUN('usermod', '--shell', self.shell(), self.name)
+		return cls(accounts().uid(uid).pw_name)
+
+	def changes(self, entry):
+		#Pairs of attribute name and new value for every attribute of entry
+		#which differs from this definition
+		changes = []
+		if entry.pw_dir != self.homedir().path:
+			changes.append(('homedir', self.homedir().path))
+		if entry.pw_uid != self.uid():
+			changes.append(('uid', self.uid()))
+		if self.group() and self.group().gid() is not None and entry.pw_gid != self.group().gid():
+			changes.append(('group', self.group().gid()))
+		if entry.pw_gecos != self.comment() and self.comment() is not None:
+			changes.append(('comment', self.comment()))
+		if entry.pw_shell != self.shell():
+			changes.append(('shell', self.shell()))
+		if self.groups() != set(Group(g) for g in accounts().members.get(self.name, ())):
+			changes.append(('groups', sorted(g.name for g in self.groups())))
+		return changes
+
+	def create(self, changes=()):
+		Accounts.backend.add_user(self.name, list(changes))
+		invalidate_accounts()
+
+	def modify(self, changes):
+		Accounts.backend.modify_user(self.name, list(changes))
+		invalidate_accounts()
 
 	def set_password(self):
 		raise NotImplementedError
 
-	def set_groups(self):
-		RUN('usermod', '-G', ','.join(g.name for g in self.groups()), self.name)
-
 	def delete(self):
-		RUN('userdel', self.name)
+		Accounts.backend.delete_user(self.name)
+		invalidate_accounts()
 
 	def runners(self, notifiers):
 		try:
-			entry = pwd.getpwnam(self.name)
+			exists = accounts().user(self.name) is not None
 		except KeyError:
-			if self.present():
-				yield self.create
-				entry = pwd.getpwnam(self.name)
+			exists = False
 		if not self.present():
-			yield self.delete
-		else:
-			if entry.pw_dir != self.homedir().path:
-				yield self.set_homedir
-			if entry.pw_uid != self.uid():
-				yield self.set_uid
-			if self.group() and entry.pw_gid != self.group().gid():
-				yield self.set_group
-			if entry.pw_gecos != self.comment():
-				yield self.set_comment
-			if entry.pw_shell != self.shell():
-				yield self.shell
-			if self.groups() != set(Group(g.gr_name) for g in grp.getgrall() if self.name in g.gr_mem):
-				yield self.set_groups
+			if exists:
+				yield self.delete, "User exists"
+			return
+		#All attributes are applied at once, so /etc/passwd is only
+		#locked and rewritten by a single useradd or usermod
+		changes = self.changes(getpwd(self.name))
+		if not exists:
+			yield (lambda:self.create(changes)), "User doesn't exist"
+		elif changes:
+			yield (lambda:self.modify(changes)), "Changing %s" % ', '.join(k for k,v in changes)
 
 def AdminUser(*args, **kwargs):
 	return User(*args, **kwargs)
@@ -788,7 +1720,7 @@ def SysUser(*args, **kwargs):
 
 def getgr(name):
 	try:
-		return grp.getgrnam(name)
+		return accounts().group(name)
 	except KeyError:
 		p = type('struct_grp', (object,), {})()
 		p.gr_gid = None
@@ -798,7 +1730,11 @@ def getgr(name):
 		return p
 
 class Group(Definition):
-	args = ['name']
+	resources = ('passwd',)
+
+	def __init__(self, name):
+		Definition.__init__(self, name)
+		Accounts.backend.attach(self)
 
 	present = param.boolean('present', True)
 	
@@ -815,7 +1751,7 @@ class Group(Definition):
 	def fromgid(cls, gid):
 		if gid is None:
 			return None
-		return cls(grp.getgrgid(gid).gr_name)
+		return cls(accounts().gid(gid).gr_name)
 
 	def add(self, user):
 		user = User(user) if isinstance(user, basestring) else user
@@ -825,26 +1761,23 @@ class Group(Definition):
 		user.groups = groups
 
 	def create_group(self):
-		cmd = ['groupadd']
-		if self.gid():
-			cmd.extend(['-g', self.gid()])
-		cmd.append(self.name)
-		RUN(*cmd)
+		Accounts.backend.add_group(self.name, self.gid())
+		invalidate_accounts()
 
 	def delete_group(self):
-		logger.debug(groupdel)
-		RUN('groupdel', self.name)
+		Accounts.backend.delete_group(self.name)
+		invalidate_accounts()
 
 	def set_gid(self):
 		raise NotImplementedError
 
 	def runners(self, notifiers):
 		try:
-			entry = grp.getgrnam(self.name)
+			entry = accounts().group(self.name)
 		except KeyError:
 			if self.present():
 				yield self.create_group
-				entry = grp.getgrnam(self.name)
+				entry = accounts().group(self.name)
 		if not self.present():
 			yield self.delete_group
 		else:
@@ -863,14 +1796,65 @@ class Exec(Definition):
 			return new
 		raise ValueError, "Invalid command: %r" % new
 
+def parse_systemctl_show(output, names):
+	'''
+	States of names from the output of systemctl show --property=ActiveState
+	for their units, which lists them in the same order
+
+	>>> sorted(parse_systemctl_show('ActiveState=active\\n\\nActiveState=inactive\\n', ['ssh', 'cron']).items())
+	[('cron', 'stopped'), ('ssh', 'running')]
+	'''
+	states = re.findall('^ActiveState=(.*)$', output, re.M)
+	return dict((name, 'running' if state in ('active', 'reloading') else 'stopped')
+	 for name, state in zip(names, states))
+
+def parse_status_all(output):
+	'''
+	States of the init scripts listed by service --status-all, leaving out
+	those which don't support status
+
+	>>> sorted(parse_status_all(' [ + ]  ssh\\n [ - ]  cron\\n [ ? ]  hwclock.sh\\n').items())
+	[('cron', 'stopped'), ('ssh', 'running')]
+	'''
+	flags = {'+':'running', '-':'stopped'}
+	return dict((name, flags[flag]) for flag, name in
+	 re.findall(r'^\s*\[ ([-+?]) \]\s+(\S+)', output, re.M) if flag in flags)
+
+def service_states():
+	#The state of every declared service, queried with a single command once
+	#per run. Services it doesn't cover are left to Service.status.
+	def load():
+		#Other workers may be adding definitions during a parallel run
+		with manifest.lock:
+			names = sorted(n.name for n in manifest.sorter.vertices if isinstance(n, Service))
+		if not names:
+			return {}
+		try:
+			if os.path.isdir('/run/systemd/system'):
+				units = [n if '.' in n else n + '.service' for n in names]
+				output, _ = RUN('systemctl', 'show', '--property=ActiveState', *units)
+				return parse_systemctl_show(output, names)
+			else:
+				#Init scripts print to either stream
+				output, errors = RUN('service', '--status-all')
+				return parse_status_all(output + errors)
+		except (OSError, ReturnCode), e:
+			logger.debug('Unable to query services: %s', e)
+			return {}
+	return manifest.probe('services', None, load)
+
 class Service(Definition):
 	args = ['name']
+	resources = ('service',)
 
 	@param.enum('running', 'stopped')
 	def state(self, new):
 		return new.lower()
 	@state.fetch
 	def state(self):
+		return self.get_state()
+
+	def status(self):
 		try:
 			RUN('service', self.name, 'status', expect=0)
 		except ReturnCode, r:
@@ -879,19 +1863,25 @@ class Service(Definition):
 			return 'running'
 
 	def get_state(self):
-		return 'stopped'
+		states = service_states()
+		if self.name not in states:
+			states[self.name] = self.status()
+		return states[self.name]
 
 	def start(self):
 		getLogger('service').debug('starting %r', self.name)
 		getLogger('service').debug('%s\n%s', *RUN('service', self.name, 'start'))
+		service_states()[self.name] = 'running'
 
 	def stop(self):
 		getLogger('service').debug('stopping %r', self.name)
 		getLogger('service').debug('%s\n%s', *RUN('service', self.name, 'stop'))
+		service_states()[self.name] = 'stopped'
 
 	def restart(self):
 		getLogger('service').debug('restarting %r', self.name)
 		getLogger('service').debug('%s\n%s', *RUN('service', self.name, 'restart'))
+		service_states()[self.name] = 'running'
 
 	def reload(self):
 		RUN('service', self.name, 'reload')
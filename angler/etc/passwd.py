@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+from ..common import *
+
+import collections
+import fcntl
+import grp
+import os
+import pwd
+import tempfile
+import time
+
+logger = getLogger('passwd')
+
+class AccountFiles(object):
+	'''
+	An account backend which reads passwd, group, shadow and gshadow under
+	root once, applies the changes of every User and Group in memory and
+	writes each changed file back atomically when CommitAccountChanges runs.
+
+	>>> root = tempfile.mkdtemp()
+	>>> os.mkdir(os.path.join(root, 'etc'))
+	>>> open(os.path.join(root, 'etc', 'passwd'), 'w').write('root:x:0:0:root:/root:/bin/bash\\n')
+	>>> open(os.path.join(root, 'etc', 'group'), 'w').write('root:x:0:\\nusers:x:100:\\n')
+	>>> files = AccountFiles(root)
+	>>> files.add_group('staff')
+	>>> files.add_user('bob', [('homedir', '/home/bob'), ('shell', '/bin/sh'), ('groups', ['staff'])])
+	>>> sorted(files.changed)
+	['group', 'passwd', 'shadow']
+	>>> files.load().users['bob'].pw_uid, sorted(files.load().members['bob'])
+	(1000, ['staff'])
+	>>> files.commit()
+	>>> print open(os.path.join(root, 'etc', 'passwd')).read(),
+	root:x:0:0:root:/root:/bin/bash
+	bob:x:1000:100::/home/bob:/bin/sh
+	>>> print open(os.path.join(root, 'etc', 'group')).read(),
+	root:x:0:
+	users:x:100:
+	staff:x:1000:bob
+	'''
+	# Number of fields per line of each file
+	tables = {'passwd':7, 'group':4, 'shadow':9, 'gshadow':4}
+	# Permissions for files which don't exist yet
+	modes = {'passwd':0644, 'group':0644, 'shadow':0640, 'gshadow':0640}
+	first_id, last_id = 1000, 60000
+	users_gid = 100
+
+	def __init__(self, root='/'):
+		self.root = root
+		self.entries = None
+		self.changed = set()
+
+	def path(self, name):
+		return os.path.join(self.root, 'etc', name)
+
+	def read(self):
+		self.entries, self.stamps, self.changed = {}, {}, set()
+		self.used = collections.defaultdict(set)
+		for name, width in self.tables.items():
+			entries = self.entries[name] = collections.OrderedDict()
+			try:
+				with open(self.path(name)) as f:
+					self.stamps[name] = os.fstat(f.fileno()).st_mtime
+					for line in f:
+						fields = line.rstrip('\n').split(':')
+						if fields[0]:
+							self.add_entry(name, fields + [''] * (width - len(fields)))
+			except IOError:
+				self.stamps[name] = None
+
+	def table(self, name):
+		if self.entries is None:
+			self.read()
+		return self.entries[name]
+
+	def load(self):
+		passwd, groups = [], []
+		for f in self.table('passwd').values():
+			if f[2].isdigit() and f[3].isdigit():
+				passwd.append(pwd.struct_passwd((f[0], f[1], int(f[2]), int(f[3]), f[4], f[5], f[6])))
+		for f in self.table('group').values():
+			if f[2].isdigit():
+				groups.append(grp.struct_group((f[0], f[1], int(f[2]), filter(None, f[3].split(',')))))
+		return Accounts(passwd, groups)
+
+	def attach(self, definition):
+		CommitAccountChanges().requires(definition)
+
+	def add_entry(self, name, fields):
+		self.entries[name][fields[0]] = fields
+		if name in ('passwd', 'group') and fields[2].isdigit():
+			self.used[name].add(int(fields[2]))
+
+	def update(self, name, fields):
+		self.table(name)
+		self.add_entry(name, fields)
+		self.changed.add(name)
+
+	def remove(self, name, key):
+		if self.table(name).pop(key, None) is not None:
+			self.changed.add(name)
+
+	def next_id(self, name):
+		#Lowest free id, ids of removed entries aren't reused within a run
+		self.table(name)
+		for i in xrange(self.first_id, self.last_id):
+			if i not in self.used[name]:
+				return i
+		raise ValueError, "No free id left in %s" % self.path(name)
+
+	def set_members(self, user, groups):
+		#group and gshadow both list members in their last field
+		for name in ('group', 'gshadow'):
+			for key, fields in self.table(name).items():
+				members = filter(None, fields[-1].split(','))
+				if (key in groups) != (user in members):
+					if key in groups:
+						members.append(user)
+					else:
+						members.remove(user)
+					self.update(name, fields[:-1] + [','.join(members)])
+
+	def add_user(self, name, changes):
+		days = str(int(time.time() // 86400))
+		self.update('passwd', [name, 'x', str(self.next_id('passwd')),
+		 str(self.users_gid), '', '', ''])
+		self.update('shadow', [name, '!', days, '0', '99999', '7', '', '', ''])
+		self.modify_user(name, changes)
+
+	def modify_user(self, name, changes):
+		fields = list(self.table('passwd')[name])
+		index = {'uid':2, 'group':3, 'comment':4, 'homedir':5, 'shell':6}
+		for key, value in changes:
+			if key == 'groups':
+				self.set_members(name, value)
+			else:
+				fields[index[key]] = str(value)
+		self.update('passwd', fields)
+
+	def delete_user(self, name):
+		self.set_members(name, ())
+		self.remove('passwd', name)
+		self.remove('shadow', name)
+
+	def add_group(self, name, gid=None):
+		gid = self.next_id('group') if gid is None else gid
+		self.update('group', [name, 'x', str(gid), ''])
+		if self.stamps['gshadow'] is not None:
+			self.update('gshadow', [name, '!', '', ''])
+
+	def delete_group(self, name):
+		self.remove('group', name)
+		self.remove('gshadow', name)
+
+	def lock(self):
+		#Same lock file and kind of lock as lckpwdf(3)
+		fd = os.open(self.path('.pwd.lock'), os.O_WRONLY|os.O_CREAT, 0600)
+		fcntl.lockf(fd, fcntl.LOCK_EX)
+		return fd
+
+	def write(self, name):
+		with atomic_file(self.path(name), self.modes[name]) as f:
+			for fields in self.table(name).values():
+				f.write(':'.join(fields) + '\n')
+
+	def commit(self):
+		fd = self.lock()
+		try:
+			for name in self.changed:
+				try:
+					stamp = os.stat(self.path(name)).st_mtime
+				except OSError:
+					stamp = None
+				if stamp != self.stamps[name]:
+					raise IOError, "%s was modified by another process" % self.path(name)
+			for name in sorted(self.changed):
+				logger.debug('writing %r', self.path(name))
+				self.write(name)
+		finally:
+			os.close(fd)
+		self.read()
+
+class CommitAccountChanges(Definition):
+	resources = ('passwd',)
+
+	def runners(self, notifiers):
+		changed = getattr(Accounts.backend, 'changed', None)
+		if changed:
+			yield Accounts.backend.commit, "Writing %s" % ', '.join(sorted(changed))
+
+def use(root='/'):
+	'''
+	Switches every User and Group definition to the file backend, including
+	those created before. Definitions which need the accounts written to
+	disk should require CommitAccountChanges().
+	'''
+	Accounts.backend = AccountFiles(root)
+	with manifest.lock:
+		existing = [n for n in manifest.sorter.vertices if isinstance(n, (User, Group))]
+	for definition in existing:
+		Accounts.backend.attach(definition)
+	return Accounts.backend
+
+if __name__=='__main__':
+	import doctest
+	doctest.testmod()
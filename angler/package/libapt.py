@@ -3,64 +3,358 @@
 from ..common import *
 
 import apt
-import multiprocessing
+import apt_pkg
+import contextlib
+import fcntl
 import os
+import Queue
 import sys
+import threading
+import time
 
 logger = getLogger('apt')
 
-apt_cache = apt.cache.Cache()
+#Seconds the last of each slow apt operation took
+timings = {}
+
+@contextlib.contextmanager
+def timed(name):
+	start = time.time()
+	try:
+		yield
+	finally:
+		timings[name] = time.time() - start
+		logger.debug('%s took %.2fs', name, timings[name])
+
+_apt_cache = None
+_apt_cache_lock = threading.Lock()
+
+def apt_cache():
+	#Opening the cache takes seconds, so it is only done once a definition
+	#needs it rather than whenever angler is imported or the packages change
+	global _apt_cache
+	with _apt_cache_lock:
+		if _apt_cache is None:
+			with timed('open'):
+				_apt_cache = apt.cache.Cache()
+		return _apt_cache
+
+def close_apt_cache():
+	#The cache is out of date, reopen it when it is next needed
+	global _apt_cache
+	with _apt_cache_lock:
+		_apt_cache = None
+
+def apt_changes():
+	#Nothing can be marked in a cache which hasn't been opened
+	return apt_cache().get_changes() if _apt_cache is not None else []
+
+def parse_status(lines):
+	#Yields the fields of each paragraph of a dpkg status file, without
+	#the continuation lines of multi-line fields
+	fields = {}
+	for line in lines:
+		line = line.rstrip('\n')
+		if not line:
+			if fields:
+				yield fields
+			fields = {}
+		elif line[0] not in ' \t':
+			key, _, value = line.partition(':')
+			fields[key] = value.strip()
+	if fields:
+		yield fields
+
+class PackageIndex(object):
+	'''
+	Which packages are installed according to the dpkg status file, which
+	is much quicker to read than opening the apt cache.
+
+	>>> from StringIO import StringIO
+	>>> index = PackageIndex(StringIO("""Package: bash
+	... Status: install ok installed
+	... Architecture: amd64
+	... Description: GNU Bourne Again SHell
+	...  Bash is an sh-compatible command language interpreter.
+	...
+	... Package: nano
+	... Status: deinstall ok config-files
+	... Architecture: amd64
+	...
+	... Package: libc6
+	... Status: install ok installed
+	... Architecture: i386
+	... """))
+	>>> index.installed('bash'), index.installed('nano'), index.installed('vim')
+	(True, False, False)
+	>>> index.installed('libc6:i386'), index.installed('libc6:amd64')
+	(True, False)
+	'''
+	path = '/var/lib/dpkg/status'
+	#Package states in which dpkg has no version of the package unpacked
+	absent = ('not-installed', 'config-files')
+
+	def __init__(self, lines):
+		self.packages = set()
+		for fields in parse_status(lines):
+			status = fields.get('Status', '').split()
+			if status and status[-1] not in self.absent:
+				name = fields['Package']
+				self.packages.add(name)
+				self.packages.add('%s:%s' % (name, fields.get('Architecture')))
+
+	@classmethod
+	def load(cls, path=None):
+		try:
+			with open(path or cls.path) as f:
+				return cls(f)
+		except IOError:
+			return cls(())
+
+	def installed(self, name):
+		return name in self.packages
+
+def package_index():
+	#Read once per run and again after anything was installed or removed
+	return manifest.probe('dpkg', None, PackageIndex.load)
+
+def invalidate_package_index():
+	manifest.invalidate('dpkg')
+
+def mtime(path):
+	try:
+		return os.stat(path).st_mtime
+	except OSError:
+		return 0
 
 class UpdatePackageCache(Definition):
+	'''
+	Updates the package lists when they are older than max_age seconds or
+	the configured sources changed since, rather than on every run. The
+	time of the last successful update is recorded in stamp_path, and a
+	lock next to it makes concurrent runs update only once. force updates
+	regardless.
+	'''
+	resources = ('apt', 'network')
 	update = param.boolean('update', False)
+	force = param.boolean('force', False)
+
+	stamp_path = '/var/cache/angler/apt-update.stamp'
+	lists_path = '/var/lib/apt/lists'
+	sources_path = '/etc/apt/sources.list'
+
+	@param(86400)
+	def max_age(self, new):
+		if isinstance(new, (int, long, float)) and new >= 0:
+			return new
+		raise ValueError, "Invalid max_age: %r" % new
+
+	def sources(self):
+		#The folder is included so removing a file from it counts as a change
+		paths = [self.sources_path, self.sources_path + '.d']
+		try:
+			names = os.listdir(self.sources_path + '.d')
+		except OSError:
+			names = []
+		return paths + [os.path.join(paths[1], n) for n in names]
+
+	def last_update(self):
+		#apt only renames lists into place when they changed upstream, so the
+		#stamp covers updates which found nothing new
+		return max(mtime(self.stamp_path), mtime(self.lists_path))
+
+	def stale(self):
+		#Returns why the lists need updating or None if they are fresh
+		last = self.last_update()
+		if not last:
+			return "No previous update"
+		changed = [p for p in self.sources() if mtime(p) > last]
+		if changed:
+			return "Sources changed: %s" % ', '.join(changed)
+		age = time.time() - last
+		if age > self.max_age():
+			return "Package lists are %is old" % age
 
 	def runners(self, notifiers):
-		if self.update() or any(x.marked_install for x in apt_cache.get_changes()):
-			yield self.do_update
+		if self.force():
+			yield self.do_update, "Forced"
+		elif self.update() or any(x.marked_install for x in apt_changes()):
+			reason = self.stale()
+			if reason:
+				yield self.do_update, reason
 
 	def do_update(self):
-		logger.debug('Updating package cache')
-		apt_cache.update()
+		try:
+			folder = os.path.dirname(self.stamp_path)
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			fd = os.open(self.stamp_path + '.lock', os.O_WRONLY|os.O_CREAT, 0644)
+		except OSError, e:
+			logger.debug('Unable to record updates in %r: %s', self.stamp_path, e)
+			fd = None
+		try:
+			if fd is not None:
+				fcntl.flock(fd, fcntl.LOCK_EX)
+				#Another run may have updated while this one waited
+				if not self.force() and not self.stale():
+					logger.debug('Package cache was updated by another process')
+					return
+			logger.debug('Updating package cache')
+			with timed('update'):
+				apt_cache().update()
+			close_apt_cache()
+			if fd is not None:
+				open(self.stamp_path, 'a').close()
+				os.utime(self.stamp_path, None)
+		finally:
+			if fd is not None:
+				os.close(fd)
 
 class SilentAcquireProgress(apt.progress.base.AcquireProgress):
-	pass
+	def done(self, item):
+		logger.debug('Fetched %s', item.shortdesc)
+
+	def fail(self, item):
+		logger.debug('Unable to fetch %s', item.shortdesc)
 
 class SilentInstallProgress(apt.progress.base.InstallProgress):
-	pass
+	def fork(self):
+		#python-apt runs dpkg in a child of its own, which is the only one
+		#that needs its output sent to /dev/null
+		pid = os.fork()
+		if pid == 0:
+			r = os.open(os.devnull, os.O_RDWR)
+			for i in range(3):
+				os.dup2(r, i)
+		return pid
+
+def quote(value, chars):
+	#Escapes the way apt does when naming files in its archive cache
+	return ''.join('%%%02x' % ord(c) if c in chars else c for c in value)
+
+def archive_name(version):
+	return '%s_%s_%s.deb' % (quote(version.package.name, '_:'),
+	 quote(version.version, '_:'), quote(version.architecture, '_:.'))
+
+class Prefetcher(object):
+	'''
+	Downloads the archives of packages marked for installation into the apt
+	archive cache in a background thread, while the rest of the graph runs,
+	so committing only has to unpack them. Archives which fail to download
+	are simply left for the commit to fetch.
+	'''
+	archives = '/var/cache/apt/archives'
+
+	def __init__(self):
+		self.requested = set()
+		self.queue = Queue.Queue()
+		self.thread = None
+
+	def fetch(self, packages):
+		#Reads what to download from the cache in the calling thread, the
+		#worker only touches the network and the archive cache
+		items = []
+		for package in packages:
+			version = package.candidate
+			if not package.marked_install and not package.marked_upgrade or version is None:
+				continue
+			name = archive_name(version)
+			if name not in self.requested and version.uri:
+				self.requested.add(name)
+				items.append((version.uri, version.sha256, version.size, name))
+		if items:
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.worker)
+				self.thread.daemon = True
+				self.thread.start()
+			self.queue.put(items)
+
+	def worker(self):
+		for items in iter(self.queue.get, None):
+			try:
+				self.download(items)
+			except Exception, e:
+				logger.debug('Prefetching failed: %s', e)
+
+	def download(self, items):
+		partial = os.path.join(self.archives, 'partial')
+		fetcher = apt_pkg.Acquire(SilentAcquireProgress())
+		files = []
+		for uri, sha256, size, name in items:
+			path = os.path.join(self.archives, name)
+			if os.path.exists(path) and os.path.getsize(path) == size:
+				continue
+			item = apt_pkg.AcquireFile(fetcher, uri, hash='SHA256:%s' % sha256 if sha256 else '',
+			 size=size, descr=name, short_descr=name, destfile=os.path.join(partial, name))
+			files.append((item, path))
+		if not files:
+			return
+		logger.debug('Prefetching %i archives', len(files))
+		fetcher.run()
+		for item, path in files:
+			if item.status == item.STAT_DONE:
+				os.rename(item.destfile, path)
+
+	def wait(self):
+		#Blocks until everything requested so far was downloaded
+		if self.thread is not None:
+			self.queue.put(None)
+			self.thread.join()
+			self.thread = None
+
+prefetcher = Prefetcher()
+
+def marked_along(package):
+	#package and whatever was marked for installation with it, found by
+	#following the dependencies of marked packages rather than scanning the
+	#whole cache with get_changes. Virtual packages aren't followed, their
+	#providers are left for the commit to fetch.
+	cache = apt_cache()
+	found, seen, stack = [], set([package.name]), [package]
+	while stack:
+		package = stack.pop()
+		if not package.marked_install and not package.marked_upgrade:
+			continue
+		found.append(package)
+		for dep in package.candidate.get_dependencies('PreDepends', 'Depends', 'Recommends'):
+			for base in dep.or_dependencies:
+				if base.name not in seen and base.name in cache:
+					seen.add(base.name)
+					stack.append(cache[base.name])
+	return found
 
 class CommitPackageChanges(Definition):
+	resources = ('apt',)
 	force = param.boolean('force', False)
 	changes_found = param.boolean('changes_found', False)
 	upgrade = param.boolean('upgrade', False)
 
 	def do_upgrade(self):
 		logger.debug('Upgrading packages')
-		apt_cache.upgrade()
+		apt_cache().upgrade()
 
 	def do_install(self):
-		logger.debug('Committing changes to %i packages', len(apt_cache.get_changes()))
-		ap = SilentAcquireProgress()
-		ip = SilentInstallProgress()
-		def commit(ap, ip):
-			r = os.open(os.devnull, os.O_RDWR)
-			for i in range(3):
-				os.close(i)
-				if r != i:
-					os.dup2(r, i)
-			apt_cache.commit(ap, ip)
-		proc = multiprocessing.Process(target=commit, args=(ap, ip))
-		proc.start()
-		proc.join()
+		with timed('prefetch'):
+			prefetcher.wait()
+		logger.debug('Committing changes to %i packages', len(apt_cache().get_changes()))
+		try:
+			with timed('commit'):
+				apt_cache().commit(SilentAcquireProgress(), SilentInstallProgress())
+		finally:
+			#Both are reread when next needed, usually the status file alone
+			invalidate_package_index()
+			close_apt_cache()
 		logger.debug('Finished committing changes')
-		apt_cache.open()
 
 	def runners(self, notifiers):
-		if self.force() or apt_cache.get_changes():
+		if self.force() or apt_changes():
 			if self.upgrade():
 				yield self.do_upgrade
 			yield self.do_install
 
 class Package(Definition):
+	resources = ('apt',)
+
 	def __init__(self, name):
 		Definition.__init__(self, name)
 		CommitPackageChanges().requires(self)
@@ -75,28 +369,44 @@ class Package(Definition):
 	def source(self, new):
 		if new is None:
 			return new
+		elif isinstance(new, basestring) and uri(new).scheme in ('http','https'):
+			new = Cache(new)
 		elif isinstance(new, basestring):
-			return Path(new, state='file')
-		elif isinstance(new, Path):
-			return new
-		raise ValueError, "Invalid source: %r"
+			new = Path(new, state='file')
+		elif not isinstance(new, (Path, Cache)):
+			raise ValueError, "Invalid source: %r" % new
+		#Bypass dep_standin, the package itself needs its source first
+		self.manifest.add(self, new)
+		return new
+
+	def source_path(self):
+		source = self.source()
+		return source.path() if isinstance(source, Cache) else source.path
 
 	def dpkg_install(self):
-		RUN('dpkg', '-i', self.source().path)
+		RUN('dpkg', '-i', self.source_path())
+		invalidate_package_index()
 
 	def mark_install(self):
 		logger.debug('Marking package %r for installation', self.name)
-		apt_cache[self.name].mark_install()
+		package = apt_cache()[self.name]
+		package.mark_install()
+		prefetcher.fetch(marked_along(package))
 
 	def mark_delete(self):
 		logger.debug('Marking package %r for removal', self.name)
-		apt_cache[self.name].mark_delete()
+		apt_cache()[self.name].mark_delete()
 
 	def runners(self, notifiers):
+		source, state = self.source(), self.state()
+		#A package which is already as wanted needs nothing from the apt
+		#cache, which is only opened to mark changes
+		if package_index().installed(self.name) == (state == 'installed'):
+			return
 		try:
-			source, state, package = self.source(), self.state(), apt_cache[self.name]
+			package = apt_cache()[self.name]
 		except KeyError:
-			source, state, package = self.source(), self.state(), None
+			package = None
 		if source is None:
 			if package is None:
 				raise KeyError, "Unable to find package %r" % self.name
@@ -109,3 +419,7 @@ class Package(Definition):
 				yield self.dpkg_install
 			elif state == 'removed' and package is not None:
 				yield self.mark_delete
+
+if __name__=='__main__':
+	import doctest
+	doctest.testmod()
@@ -3,6 +3,7 @@
 class CycleError(Exception):
 	def __init__(self, members):
 		Exception.__init__(self, 'Cycle detected: %s'%', '.join(map(repr,members)))
+		self.members = members
 
 class Topsort(object):
 	'''
@@ -27,6 +28,11 @@ class Topsort(object):
 	>>> map(sorted, sorter.cascade('b'))
 	[['b'], ['a']]
 
+	Dependencies and dependents of a node are both indexed
+
+	>>> sorted(sorter.before('a')), sorted(sorter.after('d'))
+	(['b', 'c'], ['b', 'c'])
+
 	Both resolve and cascade accept multiple arguments
 
 	>>> map(sorted, sorter.cascade('b', 'c'))
@@ -39,30 +45,68 @@ class Topsort(object):
 	Traceback (most recent call last):
 	    ...
 	CycleError: Cycle detected: 'a', 'c', 'b', 'd'
+
+	A checked sorter refuses edges that would close a cycle as soon as they
+	are added, searching only the part of the graph reachable from the new
+	dependency. The offending edge is not kept.
+
+	>>> sorter = Topsort(checked=True)
+	>>> sorter.add('a','b')
+	>>> sorter.add('b','c')
+	>>> sorter.add('c','a')
+	Traceback (most recent call last):
+	    ...
+	CycleError: Cycle detected: 'c', 'a', 'b'
+	>>> ('c','a') in sorter
+	False
+
+	Sorting is done by one of several engines, chosen by name. The default
+	'kahn' engine counts unresolved dependencies and runs in linear time,
+	'levels' is the original set-difference implementation.
+
+	>>> sorter = Topsort({'a':['b','c'], 'b':['d'], 'c':['d']}, engine='levels')
+	>>> map(sorted, sorter.resolve())
+	[['d'], ['b', 'c'], ['a']]
 	'''
-	def __init__(self, vertices=None):
-		self.vertices = dict((k,set(v)) for k,v in (vertices or {}).items())
+	engines = ('kahn', 'levels')
+
+	def __init__(self, vertices=None, checked=False, engine='kahn'):
+		if engine not in self.engines:
+			raise ValueError, "Unknown sort engine: %r" % engine
+		# vertices maps each node to the nodes it depends on, dependents is
+		#   the reverse index and is kept in step by add and discard
+		self.vertices, self.dependents = {}, {}
+		self.checked = False
+		for k,v in (vertices or {}).items():
+			self.add(k, *v)
+		self.checked = checked
+		self.engine = engine
+		self._sort = getattr(self, '_sort_' + engine)
+
+	def before(self, node):
+		return self.vertices[node]
+
+	def after(self, node):
+		return self.dependents[node]
 
-	def add(self, parent, child):
-		if parent not in self.vertices:
-			self.vertices[parent] = set()
-		self.vertices[parent].add(child)
+	@staticmethod
+	def closure(edges, nodes):
+		#All nodes reachable from nodes by following edges, including nodes
+		relevant = set(n for n in nodes if n in edges)
+		stack = list(relevant)
+		while stack:
+			for n in edges[stack.pop()]:
+				if n not in relevant:
+					relevant.add(n)
+					stack.append(n)
+		return relevant
 
 	def resolve(self, *nodes):
-		if not self.vertices:
-			def emptygen():
-				return
-				yield
-			return emptygen()
-		data = dict(self.vertices)
-		extra = reduce(set.union, data.values()) - set(data.keys())
-		data.update({item:set() for item in extra})
 		if nodes:
-			relevant,children = set(),set(nodes)
-			while not children.issubset(relevant):
-				relevant.update(children)
-				children = reduce(set.union,(data[k] for k in data if k in relevant))
-			data = dict(i for i in data.items() if i[0] in relevant)
+			relevant = self.closure(self.vertices, nodes)
+			data = dict((n,self.vertices[n]) for n in relevant)
+		else:
+			data = self.vertices
 		return self._sort(data)
 
 	def __iter__(self):
@@ -75,17 +119,58 @@ class Topsort(object):
 
 	def add(self, parent, *children):
 		p = self.vertices.setdefault(parent, set())
+		self.dependents.setdefault(parent, set())
 		for child in children:
+			if self.checked and child not in p:
+				path = self.path(child, parent)
+				if path is not None:
+					raise CycleError([parent] + path[:-1])
 			p.add(child)
 			self.vertices.setdefault(child, set())
+			self.dependents.setdefault(child, set()).add(parent)
+
+	def link(self, parent, child):
+		#Adds a single edge without the cycle check, for callers which know
+		#nothing child depends on can depend on parent
+		self.vertices.setdefault(parent, set()).add(child)
+		self.dependents.setdefault(parent, set())
+		self.vertices.setdefault(child, set())
+		self.dependents.setdefault(child, set()).add(parent)
+
+	def path(self, start, end):
+		#Depth-first search along dependencies, returns the chain of nodes
+		#leading from start to end or None if end isn't reachable. Nodes are
+		#compared the way the vertex sets compare them, by hash and equality.
+		end = set([end])
+		if start in end:
+			return [start]
+		if start not in self.vertices:
+			return None
+		seen = set([start])
+		stack = [(start, iter(self.vertices[start]))]
+		while stack:
+			node, deps = stack[-1]
+			for dep in deps:
+				if dep in end:
+					return [n for n,_ in stack] + [dep]
+				if dep not in seen:
+					seen.add(dep)
+					stack.append((dep, iter(self.vertices[dep])))
+					break
+			else:
+				stack.pop()
+		return None
 
 	def discard(self, parent, *children):
 		p = self.vertices.setdefault(parent, set())
+		self.dependents.setdefault(parent, set())
 		for child in children:
 			p.discard(child)
+			if child in self.dependents:
+				self.dependents[child].discard(parent)
 
 	@staticmethod
-	def _sort(data):
+	def _sort_levels(data):
 		#Performs the grunt work, requires a dict of node:set(dependencies)
 		while True:
 			ordered = set(item for item,dep in data.items() if not dep)
@@ -96,12 +181,37 @@ class Topsort(object):
 		if data:
 			raise CycleError(data)
 
+	@staticmethod
+	def _sort_kahn(data):
+		#Same contract as _sort_levels, but keeps a count of unresolved
+		#dependencies per node so each node and edge is visited once
+		count, dependents = {}, dict((item,[]) for item in data)
+		for item, deps in data.iteritems():
+			count[item] = len(deps)
+			for dep in deps:
+				dependents[dep].append(item)
+		ready = set(item for item,n in count.iteritems() if not n)
+		while ready:
+			yield ready
+			following = set()
+			for item in ready:
+				for dependent in dependents[item]:
+					count[dependent] -= 1
+					if not count[dependent]:
+						following.add(dependent)
+			ready = following
+		if any(count.itervalues()):
+			raise CycleError(dict((item,data[item]) for item in data if count[item]))
+
 	def cascade(self, *nodes):
-		backward = Topsort()
-		for key in self.vertices:
-			for value in self.vertices[key]:
-				backward.add(value, key)
-		return reversed(list(backward.resolve(*nodes)))
+		#Sorts the dependents of nodes as if the graph were reversed, so
+		#each node comes as late as its own dependents allow
+		if nodes:
+			relevant = self.closure(self.dependents, nodes)
+			data = dict((n,self.dependents[n]) for n in relevant)
+		else:
+			data = self.dependents
+		return reversed(list(self._sort(data)))
 
 if __name__=='__main__':
 	import doctest
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+# Times importing angler in a fresh interpreter and fails when the best of
+# several runs is over budget:
+#   PYTHONPATH=. python bench/import_time.py [budget in seconds] [runs]
+
+import os
+import subprocess
+import sys
+import time
+
+def main(budget=0.5, runs=5):
+	null = open(os.devnull, 'w')
+	times = []
+	for i in xrange(int(runs)):
+		start = time.time()
+		subprocess.check_call([sys.executable, '-c', 'import angler.globals'], stdout=null, stderr=null)
+		times.append(time.time() - start)
+	best = min(times)
+	print 'import angler.globals %8.3fs (budget %.3fs)' % (best, budget)
+	if best > budget:
+		sys.exit(1)
+
+if __name__=='__main__':
+	main(*map(float, sys.argv[1:]))
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+
+# Times declaring many files below a shared set of folders:
+#   PYTHONPATH=. python bench/paths.py [folders] [files per folder]
+
+import sys
+import time
+
+from angler.common import manifest, File
+
+def main(folders=200, files=50):
+	manifest.clear()
+	start = time.time()
+	for i in xrange(folders):
+		for j in xrange(files):
+			File('/srv/www/static/d%i/f%i' % (i, j), content='')
+	print '%6i paths %8.3fs' % (len(manifest.sorter.vertices), time.time() - start)
+
+if __name__=='__main__':
+	main(*map(int, sys.argv[1:]))
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+# Compares the Topsort sort engines on a layered random graph:
+#   PYTHONPATH=. python bench/topsort.py [vertices] [edges per vertex]
+
+import random
+import sys
+import timeit
+
+from angler.topsort import Topsort
+
+def graph(size, degree, seed=0):
+	rand = random.Random(seed)
+	vertices = {}
+	for i in range(size):
+		vertices[i] = set(rand.sample(xrange(i), min(i, degree)))
+	return vertices
+
+def main(size=20000, degree=3):
+	vertices = graph(size, degree)
+	for engine in Topsort.engines:
+		sorter = Topsort(vertices, engine=engine)
+		best = min(timeit.repeat(lambda:list(sorter.resolve()), number=1, repeat=3))
+		print '%-8s %6i vertices %8.3fs' % (engine, size, best)
+
+if __name__=='__main__':
+	main(*map(int, sys.argv[1:]))